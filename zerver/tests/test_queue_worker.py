@@ -3,16 +3,19 @@ import os
 import time
 import ujson
 import smtplib
+from collections import defaultdict
+from contextlib import ExitStack
 
 from django.conf import settings
 from django.http import HttpResponse
 from django.test import TestCase
 from mock import patch, MagicMock
-from typing import Any, Callable, Dict, List, Mapping, Tuple
+from typing import Any, Callable, Dict, List, Mapping, Sequence
 
 from zerver.lib.test_helpers import simulated_queue_client
 from zerver.lib.test_classes import ZulipTestCase
-from zerver.models import get_client, UserActivity, PreregistrationUser
+from zerver.models import get_client, get_realm, get_user, Client, UserActivity, \
+    UserProfile, PreregistrationUser
 from zerver.worker import queue_processors
 from zerver.worker.queue_processors import (
     get_active_worker_queues,
@@ -23,6 +26,9 @@ from zerver.worker.queue_processors import (
 
 Event = Dict[str, Any]
 
+_EMPTY_TITLE_JSON = '{"title":""}'
+_UNRELIABLE_ERROR_PATH = os.path.join(settings.QUEUE_ERROR_DIR, 'unreliable_worker.errors')
+
 # This is used for testing LoopQueueProcessingWorker, which
 # would run forever if we don't mock time.sleep to abort the
 # loop.
@@ -33,7 +39,10 @@ class WorkerTest(ZulipTestCase):
     class FakeClient:
         def __init__(self) -> None:
             self.consumers = {}  # type: Dict[str, Callable[[Dict[str, Any]], None]]
-            self.queue = []  # type: List[Tuple[str, Dict[str, Any]]]
+            self.queues = defaultdict(list)  # type: Dict[str, List[Dict[str, Any]]]
+
+        def enqueue(self, queue_name: str, event: Dict[str, Any]) -> None:
+            self.queues[queue_name].append(event)
 
         def register_json_consumer(self,
                                    queue_name: str,
@@ -41,29 +50,51 @@ class WorkerTest(ZulipTestCase):
             self.consumers[queue_name] = callback
 
         def start_consuming(self) -> None:
-            for queue_name, data in self.queue:
+            # Consumers may publish back into this client (e.g. retries),
+            # so keep going until every queue has been emptied.
+            while self.queues:
+                queue_name = next(iter(self.queues))
+                events = self.queues.pop(queue_name)
                 callback = self.consumers[queue_name]
-                callback(data)
+                for data in events:
+                    callback(data)
 
         def drain_queue(self, queue_name: str, json: bool) -> List[Event]:
             assert json
-            events = [
-                dct
-                for (queue_name, dct)
-                in self.queue
-            ]
-
             # IMPORTANT!
-            # This next line prevents us from double draining
+            # Popping the events prevents us from double draining
             # queues, which was a bug at one point.
-            self.queue = []
-
-            return events
+            return self.queues.pop(queue_name, [])
+
+    # Populated once per class by setUpTestData.  Django 1.11 shares these
+    # objects between test methods rather than copying them, so tests
+    # must treat them as read-only.
+    _cordelia = None  # type: UserProfile
+    _hamlet = None  # type: UserProfile
+    _othello = None  # type: UserProfile
+    _iago = None  # type: UserProfile
+    _ios_client = None  # type: Client
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        realm = get_realm('zulip')
+        cls._cordelia = get_user(cls.example_user_map['cordelia'], realm)
+        cls._hamlet = get_user(cls.example_user_map['hamlet'], realm)
+        cls._othello = get_user(cls.example_user_map['othello'], realm)
+        cls._iago = get_user(cls.example_user_map['iago'], realm)
+        cls._ios_client = get_client('ios')
+
+    def _make_client(self, queue_name: str,
+                     events: Sequence[Event]) -> 'WorkerTest.FakeClient':
+        fake_client = self.FakeClient()
+        for event in events:
+            fake_client.enqueue(queue_name, event)
+        return fake_client
 
     def test_missed_message_worker(self) -> None:
-        cordelia = self.example_user('cordelia')
-        hamlet = self.example_user('hamlet')
-        othello = self.example_user('othello')
+        cordelia = self._cordelia
+        hamlet = self._hamlet
+        othello = self._othello
 
         hamlet1_msg_id = self.send_personal_message(
             from_email=cordelia.email,
@@ -89,9 +120,7 @@ class WorkerTest(ZulipTestCase):
             dict(user_profile_id=othello.id, message_id=othello_msg_id),
         ]
 
-        fake_client = self.FakeClient()
-        for event in events:
-            fake_client.queue.append(('missedmessage_emails', event))
+        fake_client = self._make_client('missedmessage_emails', events)
 
         mmw = MissedMessageWorker()
 
@@ -114,50 +143,45 @@ class WorkerTest(ZulipTestCase):
 
         self.assertEqual(tm.call_args[0][0], 120)  # should sleep two minutes
 
-        args = [c[0] for c in sm.call_args_list]
         arg_dict = {
-            arg[0].id: dict(
-                missed_messages=arg[1],
-                count=arg[2],
-            )
-            for arg in args
+            c[0][0].id: (c[0][1], c[0][2])
+            for c in sm.call_args_list
         }
 
-        hamlet_info = arg_dict[hamlet.id]
-        self.assertEqual(hamlet_info['count'], 2)
+        missed_messages, count = arg_dict[hamlet.id]
+        self.assertEqual(count, 2)
         self.assertEqual(
-            {m.content for m in hamlet_info['missed_messages']},
+            {m.content for m in missed_messages},
             {'hi hamlet', 'goodbye hamlet'},
         )
 
-        othello_info = arg_dict[othello.id]
-        self.assertEqual(othello_info['count'], 1)
+        missed_messages, count = arg_dict[othello.id]
+        self.assertEqual(count, 1)
         self.assertEqual(
-            {m.content for m in othello_info['missed_messages']},
+            {m.content for m in missed_messages},
             {'where art thou, othello?'}
         )
 
     def test_mirror_worker(self) -> None:
-        fake_client = self.FakeClient()
+        now = time.time()
         data = [
             dict(
                 message=u'\xf3test',
-                time=time.time(),
+                time=now,
                 rcpt_to=self.example_email('hamlet'),
             ),
             dict(
                 message='\xf3test',
-                time=time.time(),
+                time=now,
                 rcpt_to=self.example_email('hamlet'),
             ),
             dict(
                 message='test',
-                time=time.time(),
+                time=now,
                 rcpt_to=self.example_email('hamlet'),
             ),
         ]
-        for element in data:
-            fake_client.queue.append(('email_mirror', element))
+        fake_client = self._make_client('email_mirror', data)
 
         with patch('zerver.worker.queue_processors.mirror_email'):
             with simulated_queue_client(lambda: fake_client):
@@ -165,63 +189,55 @@ class WorkerTest(ZulipTestCase):
                 worker.setup()
                 worker.start()
 
-    def test_email_sending_worker_retries(self) -> None:
-        """Tests the retry_send_email_failures decorator to make sure it
-        retries sending the email 3 times and then gives up."""
-        fake_client = self.FakeClient()
-
-        data = {'test': 'test', 'id': 'test_missed'}
-        fake_client.queue.append(('missedmessage_email_senders', data))
+    def _run_retry_worker(self, worker_cls: Callable[[], QueueProcessingWorker],
+                          queue_name: str, data: Dict[str, Any],
+                          patches: List[Any]) -> None:
+        fake_client = self._make_client(queue_name, [data])
 
         def fake_publish(queue_name: str,
                          event: Dict[str, Any],
                          processor: Callable[[Any], None]) -> None:
-            fake_client.queue.append((queue_name, event))
+            fake_client.enqueue(queue_name, event)
 
         with simulated_queue_client(lambda: fake_client):
-            worker = queue_processors.MissedMessageSendingWorker()
+            worker = worker_cls()
             worker.setup()
-            with patch('zerver.worker.queue_processors.send_email_from_dict',
-                       side_effect=smtplib.SMTPServerDisconnected), \
-                    patch('zerver.lib.queue.queue_json_publish',
-                          side_effect=fake_publish), \
-                    patch('logging.exception'):
+            with ExitStack() as stack:
+                for context in patches:
+                    stack.enter_context(context)
+                stack.enter_context(patch('zerver.lib.queue.queue_json_publish',
+                                          side_effect=fake_publish))
                 worker.start()
 
         self.assertEqual(data['failed_tries'], 4)
 
-    def test_signups_worker_retries(self) -> None:
-        """Tests the retry logic of signups queue."""
-        fake_client = self.FakeClient()
-
-        user_id = self.example_user('hamlet').id
-        data = {'user_id': user_id, 'id': 'test_missed'}
-        fake_client.queue.append(('signups', data))
-
-        def fake_publish(queue_name: str, event: Dict[str, Any], processor: Callable[[Any], None]) -> None:
-            fake_client.queue.append((queue_name, event))
+    def test_worker_retries(self) -> None:
+        """Tests that the missed message email sending and signups queues
+        retry an event 3 times and then give up."""
+        self._run_retry_worker(
+            queue_processors.MissedMessageSendingWorker,
+            'missedmessage_email_senders',
+            {'test': 'test', 'id': 'test_missed'},
+            [patch('zerver.worker.queue_processors.send_email_from_dict',
+                   side_effect=smtplib.SMTPServerDisconnected),
+             patch('logging.exception')])
 
         fake_response = MagicMock()
         fake_response.status_code = 400
-        fake_response.text = ujson.dumps({'title': ''})
-        with simulated_queue_client(lambda: fake_client):
-            worker = queue_processors.SignupWorker()
-            worker.setup()
-            with patch('zerver.worker.queue_processors.requests.post',
-                       return_value=fake_response), \
-                    patch('zerver.lib.queue.queue_json_publish',
-                          side_effect=fake_publish), \
-                    patch('logging.info'), \
-                    self.settings(MAILCHIMP_API_KEY='one-two',
-                                  PRODUCTION=True,
-                                  ZULIP_FRIENDS_LIST_ID='id'):
-                worker.start()
-
-        self.assertEqual(data['failed_tries'], 4)
+        fake_response.text = _EMPTY_TITLE_JSON
+        self._run_retry_worker(
+            queue_processors.SignupWorker,
+            'signups',
+            {'user_id': self._hamlet.id, 'id': 'test_missed'},
+            [patch('zerver.worker.queue_processors.requests.post',
+                   return_value=fake_response),
+             patch('logging.info'),
+             self.settings(MAILCHIMP_API_KEY='one-two',
+                           PRODUCTION=True,
+                           ZULIP_FRIENDS_LIST_ID='id')])
 
     def test_invites_worker(self) -> None:
-        fake_client = self.FakeClient()
-        invitor = self.example_user('iago')
+        invitor = self._iago
         prereg_alice = PreregistrationUser.objects.create(
             email=self.nonreg_email('alice'), referred_by=invitor, realm=invitor.realm)
         PreregistrationUser.objects.create(
@@ -233,8 +249,7 @@ class WorkerTest(ZulipTestCase):
             # Form with `email` is from versions up to Zulip 1.7.1
             dict(email=self.nonreg_email('bob'), referrer_id=invitor.id, email_body=None),
         ]
-        for element in data:
-            fake_client.queue.append(('invites', element))
+        fake_client = self._make_client('invites', data)
 
         with simulated_queue_client(lambda: fake_client):
             worker = queue_processors.ConfirmationEmailWorker()
@@ -248,21 +263,20 @@ class WorkerTest(ZulipTestCase):
                 self.assertEqual(send_mock.call_count, 2)
 
     def test_UserActivityWorker(self) -> None:
-        fake_client = self.FakeClient()
-
-        user = self.example_user('hamlet')
+        user = self._hamlet
         UserActivity.objects.filter(
             user_profile = user.id,
-            client = get_client('ios')
+            client = self._ios_client
         ).delete()
 
+        now = time.time()
         data = dict(
             user_profile_id = user.id,
             client = 'ios',
-            time = time.time(),
+            time = now,
             query = 'send_message'
         )
-        fake_client.queue.append(('user_activity', data))
+        fake_client = self._make_client('user_activity', [data])
 
         with simulated_queue_client(lambda: fake_client):
             worker = queue_processors.UserActivityWorker()
@@ -270,7 +284,7 @@ class WorkerTest(ZulipTestCase):
             worker.start()
             activity_records = UserActivity.objects.filter(
                 user_profile = user.id,
-                client = get_client('ios')
+                client = self._ios_client
             )
             self.assertTrue(len(activity_records), 1)
             self.assertTrue(activity_records[0].count, 1)
@@ -290,13 +304,13 @@ class WorkerTest(ZulipTestCase):
                 # keep the tests quiet
                 pass
 
-        fake_client = self.FakeClient()
-        for msg in ['good', 'fine', 'unexpected behaviour', 'back to normal']:
-            fake_client.queue.append(('unreliable_worker', {'type': msg}))
+        fake_client = self._make_client(
+            'unreliable_worker',
+            [{'type': msg} for msg in ['good', 'fine', 'unexpected behaviour', 'back to normal']],
+        )
 
-        fn = os.path.join(settings.QUEUE_ERROR_DIR, 'unreliable_worker.errors')
         try:
-            os.remove(fn)
+            os.remove(_UNRELIABLE_ERROR_PATH)
         except OSError:  # nocoverage # error handling for the directory not existing
             pass
 
@@ -306,8 +320,9 @@ class WorkerTest(ZulipTestCase):
             worker.start()
 
         self.assertEqual(processed, ['good', 'fine', 'back to normal'])
-        line = open(fn).readline().strip()
-        event = ujson.loads(line.split('\t')[1])
+        with open(_UNRELIABLE_ERROR_PATH) as f:
+            line = f.readline().strip()
+        event = ujson.loads(line.split('\t', 1)[1])
         self.assertEqual(event["type"], 'unexpected behaviour')
 
     def test_worker_noname(self) -> None:
@@ -333,5 +348,6 @@ class WorkerTest(ZulipTestCase):
     def test_get_active_worker_queues(self) -> None:
         worker_queue_count = (len(QueueProcessingWorker.__subclasses__()) +
                               len(LoopQueueProcessingWorker.__subclasses__()) - 1)
-        self.assertEqual(worker_queue_count, len(get_active_worker_queues()))
+        active_worker_queues = get_active_worker_queues()
+        self.assertEqual(worker_queue_count, len(active_worker_queues))
         self.assertEqual(1, len(get_active_worker_queues(queue_type='test')))